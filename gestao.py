@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -7,6 +8,13 @@ import json
 import os
 import base64
 
+# Opcional (fora do requirements.txt): com numba instalado, o cálculo de
+# saldos anteriores usa um kernel compilado; sem ele, usa máscaras do pandas.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # Configuração da Página
 st.set_page_config(
     page_title="Gestão Financeira Escolar - PDDE", layout="wide")
@@ -67,19 +75,82 @@ def init_firebase():
 # --- FUNÇÕES CRUD ---
 
 
+def get_accounts_version(db):
+    doc = db.collection('pdde_dados_gerais').document('versao_contas').get()
+    if doc.exists:
+        return doc.to_dict().get('versao', 0)
+    return 0
+
+
+def bump_accounts_version(db):
+    db.collection('pdde_dados_gerais').document('versao_contas').set(
+        {'versao': firestore.Increment(1)}, merge=True)
+
+
+# Firestore aceita no máximo 500 operações por batch
+_LIMITE_LOTE = 450
+
+
+def _commit_em_lotes(db, operacoes):
+    """
+    Executa operações [('set', ref, dados) | ('delete', ref)] em batches de
+    até _LIMITE_LOTE, na ordem informada.
+    """
+    for i in range(0, len(operacoes), _LIMITE_LOTE):
+        batch = db.batch()
+        for metodo, ref, *dados in operacoes[i:i + _LIMITE_LOTE]:
+            getattr(batch, metodo)(ref, *dados)
+        batch.commit()
+
+
+def _movimentacoes_por_mes(movs):
+    grupos = {}
+    for mov in movs:
+        chave = (int(mov.get('ano', datetime.now().year)), int(mov['mes_num']))
+        grupos.setdefault(chave, []).append(mov)
+    return grupos
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_accounts_snapshot(_db, versao):
+    contas = {doc.id: doc.to_dict() for doc in _db.collection('pdde_contas').get()}
+
+    # Movimentações gravadas por mês em pdde_contas/{conta}/movimentacoes/{ano}_{mes}
+    meses_por_conta = {}
+    for doc in _db.collection_group('movimentacoes').get():
+        conta_ref = doc.reference.parent.parent
+        if conta_ref is not None and conta_ref.id in contas:
+            meses_por_conta.setdefault(conta_ref.id, []).append(doc.to_dict())
+
+    legado = []
+    for nome, dados in contas.items():
+        if 'movimentacoes' in dados:
+            legado.append(nome)
+        meses = meses_por_conta.get(nome, [])
+        # Contas antigas guardam as movimentações no próprio documento;
+        # os meses já gravados na subcoleção têm prioridade sobre elas.
+        gravados = {(int(m['ano']), int(m['mes_num'])) for m in meses}
+        movs_legado = [m for chave, regs in _movimentacoes_por_mes(
+            dados.get('movimentacoes', [])).items() if chave not in gravados for m in regs]
+        dados['movimentacoes'] = movs_legado + \
+            [r for m in meses for r in m.get('registros', [])]
+    return contas, legado
+
+
 def load_accounts_from_firebase(db):
+    """
+    Retorna (contas, contas_legado): contas_legado são as que ainda guardam
+    as movimentações no próprio documento e precisam ser migradas ao salvar.
+    """
     if db is None:
-        return {}
+        return {}, set()
     try:
-        accounts_ref = db.collection('pdde_contas')
-        docs = accounts_ref.stream()
-        dados = {}
-        for doc in docs:
-            dados[doc.id] = doc.to_dict()
-        return dados
+        # O snapshot completo só é relido quando a versão no Firestore muda
+        contas, legado = _load_accounts_snapshot(db, get_accounts_version(db))
+        return contas, set(legado)
     except Exception as e:
         st.error(f"Erro ao ler contas: {e}")
-        return {}
+        return {}, set()
 
 
 def load_empenhos_from_firebase(db):
@@ -151,20 +222,67 @@ def delete_file_from_firebase(db, empenho_id):
 # --- FUNÇÕES SALVAMENTO ---
 
 
-def save_account_to_firebase(db, account_name, account_data):
+def get_account_version(account_name):
+    return st.session_state.setdefault('account_versions', {}).get(account_name, 0)
+
+
+def bump_account_version(account_name):
+    versions = st.session_state.setdefault('account_versions', {})
+    versions[account_name] = versions.get(account_name, 0) + 1
+
+
+def save_account_to_firebase(db, account_name, account_data, meses=None):
+    """
+    O documento da conta guarda programas, saldos iniciais e ajustes; as
+    movimentações ficam na subcoleção 'movimentacoes', um documento por mês.
+    Se meses ([(ano, mes), ...]) for informado, só esses meses são gravados;
+    senão só o documento da conta (e todos os meses, se a conta ainda estiver
+    no formato antigo e precisar ser migrada).
+    """
+    bump_account_version(account_name)
     if db is None:
         return
     try:
-        db.collection('pdde_contas').document(account_name).set(account_data)
+        conta_ref = db.collection('pdde_contas').document(account_name)
+        por_mes = _movimentacoes_por_mes(account_data.get('movimentacoes', []))
+        legado = st.session_state.setdefault('contas_legado', set())
+        migrar = meses is None and account_name in legado
+        if migrar:
+            meses = list(por_mes.keys())
+
+        operacoes = []
+        for ano, mes in meses or []:
+            mes_ref = conta_ref.collection(
+                'movimentacoes').document(f"{ano}_{mes}")
+            if (ano, mes) in por_mes:
+                operacoes.append(('set', mes_ref, {'ano': ano, 'mes_num': mes,
+                                                   'registros': por_mes[(ano, mes)]}))
+            else:
+                operacoes.append(('delete', mes_ref))
+        if meses is None or migrar:
+            # Por último: na migração, só remove a lista antiga depois dos meses gravados
+            operacoes.append(('set', conta_ref, {
+                k: v for k, v in account_data.items() if k != 'movimentacoes'}))
+        _commit_em_lotes(db, operacoes)
+        if migrar:
+            legado.discard(account_name)
+        bump_accounts_version(db)
     except Exception as e:
         st.error(f"Erro ao salvar conta: {e}")
 
 
 def delete_account_from_firebase(db, account_name):
+    bump_account_version(account_name)
     if db is None:
         return
     try:
-        db.collection('pdde_contas').document(account_name).delete()
+        conta_ref = db.collection('pdde_contas').document(account_name)
+        operacoes = [('delete', mes_doc.reference)
+                     for mes_doc in conta_ref.collection('movimentacoes').get()]
+        operacoes.append(('delete', conta_ref))
+        _commit_em_lotes(db, operacoes)
+        st.session_state.setdefault('contas_legado', set()).discard(account_name)
+        bump_accounts_version(db)
     except Exception as e:
         st.error(f"Erro ao excluir conta: {e}")
 
@@ -182,8 +300,21 @@ def rename_account_in_firebase(db, old_name, new_name):
         if not doc.exists:
             return False
         data = doc.to_dict()
-        new_ref.set(data)
-        old_ref.delete()
+        meses_docs = old_ref.collection('movimentacoes').get()
+        # Copia tudo antes de apagar, para um lote com falha não perder dados
+        operacoes = [('set', new_ref.collection('movimentacoes').document(m.id), m.to_dict())
+                     for m in meses_docs]
+        operacoes.append(('set', new_ref, data))
+        operacoes += [('delete', m.reference) for m in meses_docs]
+        operacoes.append(('delete', old_ref))
+        _commit_em_lotes(db, operacoes)
+        legado = st.session_state.setdefault('contas_legado', set())
+        if old_name in legado:
+            legado.discard(old_name)
+            legado.add(new_name)
+        bump_accounts_version(db)
+        bump_account_version(old_name)
+        bump_account_version(new_name)
         return True
     except Exception as e:
         st.error(f"Erro ao renomear: {e}")
@@ -212,6 +343,10 @@ def save_global_programs_to_firebase(db, lista_programas):
 # --- AUXILIARES (FORMATAÇÃO CORRIGIDA) ---
 
 
+# Troca ',' <-> '.' em uma única passagem (translate substitui os caracteres simultaneamente)
+_CURRENCY_TRANS = str.maketrans(",.", ".,")
+
+
 def format_currency(value):
     """
     Formata valor float para moeda brasileira:
@@ -219,16 +354,19 @@ def format_currency(value):
     """
     if value is None:
         value = 0.0
-    s = "{:,.2f}".format(value)
-    s = s.replace(",", "X").replace(".", ",").replace("X", ".")
-    return f"R$ {s}"
+    return f"R$ {value:,.2f}".translate(_CURRENCY_TRANS)
+
+
+ESTILO_TOTAL = {'background-color': '#ffd700',
+                'color': 'black', 'font-weight': 'bold'}
+ESTILO_DESTAQUE = {'background-color': '#e0f2f1',
+                   'color': 'black', 'font-weight': 'bold'}
 
 
 def apply_currency_format(df, cols):
     for col in cols:
         if col in df.columns:
-            df[col] = df[col].apply(lambda x: f"R$ {x:,.2f}".replace(
-                ",", "X").replace(".", ",").replace("X", "."))
+            df[col] = df[col].apply(format_currency)
     return df
 
 
@@ -239,9 +377,11 @@ def init_session_state():
     if 'accounts' not in st.session_state:
         if db:
             with st.spinner('Conectando ao banco de dados...'):
-                st.session_state['accounts'] = load_accounts_from_firebase(db)
+                st.session_state['accounts'], st.session_state['contas_legado'] = load_accounts_from_firebase(
+                    db)
         else:
             st.session_state['accounts'] = {}
+            st.session_state['contas_legado'] = set()
 
     if 'empenhos_global' not in st.session_state:
         if db:
@@ -272,39 +412,110 @@ def init_session_state():
         st.session_state['available_years'] = sorted(list(anos_encontrados))
 
 
-def get_saldo_anterior(account_name, programa, tipo_recurso, mes_alvo, ano_alvo):
+MESES = {1: 'Janeiro', 2: 'Fevereiro', 3: 'Março', 4: 'Abril', 5: 'Maio', 6: 'Junho',
+         7: 'Julho', 8: 'Agosto', 9: 'Setembro', 10: 'Outubro', 11: 'Novembro', 12: 'Dezembro'}
+COLS_VALORES = [
+    'credito_capital', 'credito_custeio', 'debito_capital', 'debito_custeio',
+    'rendimento_capital', 'rendimento_custeio',
+    'total_credito', 'total_debito', 'total_rendimento'
+]
+COLS_TOTAIS = ['total_credito', 'total_rendimento', 'total_debito']
+COLS_RECURSO = {
+    'Capital': ('credito_capital', 'rendimento_capital', 'debito_capital'),
+    'Custeio': ('credito_custeio', 'rendimento_custeio', 'debito_custeio'),
+}
+
+
+def get_movimentacoes_df(account_name):
+    """
+    Movimentações da conta em formato colunar (DataFrame tipado).
+    A lista de dicts em session_state continua sendo a fonte gravada no
+    Firestore; o DataFrame é reconstruído quando a versão da conta muda.
+    """
+    versao = get_account_version(account_name)
+    cache = st.session_state.setdefault('movs_df_cache', {})
+    if account_name in cache and cache[account_name][0] == versao:
+        return cache[account_name][1]
+
     conta_data = st.session_state['accounts'][account_name]
     movs = conta_data.get('movimentacoes', [])
-    saldo = 0.0
-    saldos_iniciais = conta_data.get('saldos_iniciais', {})
+    df = pd.DataFrame(movs, columns=['programa', 'mes_num', 'ano'] + COLS_VALORES)
+    df['ano'] = pd.to_numeric(df['ano'], errors='coerce').fillna(
+        datetime.now().year).astype('int16')
+    df['mes_num'] = df['mes_num'].astype('int8')
+    # Valores monetários ficam em float64: em float32 (~7 dígitos) os saldos
+    # acumulados passam a errar nos centavos a partir de algumas dezenas de milhares.
+    df[COLS_VALORES] = df[COLS_VALORES].fillna(0.0).astype('float64')
+    # Programas como categoria: filtros e groupby comparam códigos inteiros
+    programas = list(dict.fromkeys(
+        conta_data.get('programas', []) + df['programa'].dropna().tolist()))
+    df['programa'] = pd.Categorical(df['programa'], categories=programas)
+    df['programa_cod'] = df['programa'].cat.codes
+
+    cache[account_name] = (versao, df, {p: i for i, p in enumerate(programas)})
+    return df
 
-    if programa in saldos_iniciais:
-        val = saldos_iniciais[programa].get(tipo_recurso, 0.0) if tipo_recurso != 'Total' else \
-            saldos_iniciais[programa].get(
-                'Capital', 0.0) + saldos_iniciais[programa].get('Custeio', 0.0)
-        saldo += val
 
-    for mov in movs:
-        try:
-            mov_ano = int(mov.get('ano', datetime.now().year))
-        except:
-            mov_ano = datetime.now().year
-
-        mov_mes = mov['mes_num']
-        eh_passado = (mov_ano < int(ano_alvo)) or (
-            mov_ano == int(ano_alvo) and mov_mes < int(mes_alvo))
-
-        if mov['programa'] == programa and eh_passado:
-            if tipo_recurso == 'Capital':
-                saldo += (mov['credito_capital'] +
-                          mov['rendimento_capital'] - mov['debito_capital'])
-            elif tipo_recurso == 'Custeio':
-                saldo += (mov['credito_custeio'] +
-                          mov['rendimento_custeio'] - mov['debito_custeio'])
-            elif tipo_recurso == 'Total':
-                saldo += (mov['total_credito'] +
-                          mov['total_rendimento'] - mov['total_debito'])
-    return saldo
+def get_codigo_programa(account_name, programa):
+    get_movimentacoes_df(account_name)
+    return st.session_state['movs_df_cache'][account_name][2].get(programa)
+
+
+def _saldo_scan(prog_codes, anos, meses, cred_cap, rend_cap, deb_cap,
+                cred_cus, rend_cus, deb_cus, target_prog, ano_alvo, mes_alvo):
+    cap = 0.0
+    cus = 0.0
+    for i in range(prog_codes.shape[0]):
+        if prog_codes[i] == target_prog and (anos[i] < ano_alvo or (anos[i] == ano_alvo and meses[i] < mes_alvo)):
+            cap += cred_cap[i] + rend_cap[i] - deb_cap[i]
+            cus += cred_cus[i] + rend_cus[i] - deb_cus[i]
+    return cap, cus
+
+
+if njit is not None:
+    _saldo_scan = njit(cache=True)(_saldo_scan)
+
+
+def get_saldos_anteriores(account_name, programa, mes_alvo, ano_alvo):
+    """
+    Saldos de Capital e Custeio do programa antes de mes_alvo/ano_alvo,
+    calculados em uma única passagem: (capital, custeio)
+    """
+    # Cache por sessão, invalidado pela versão da conta (incrementada a cada salvamento)
+    versao = get_account_version(account_name)
+    cache = st.session_state.setdefault('saldo_cache', {})
+    chave = (account_name, programa, int(mes_alvo), int(ano_alvo))
+    if chave in cache and cache[chave][0] == versao:
+        return cache[chave][1]
+
+    conta_data = st.session_state['accounts'][account_name]
+    si = conta_data.get('saldos_iniciais', {}).get(programa, {})
+    saldo_cap = si.get('Capital', 0.0)
+    saldo_cus = si.get('Custeio', 0.0)
+
+    df = get_movimentacoes_df(account_name)
+    ano_alvo, mes_alvo = int(ano_alvo), int(mes_alvo)
+    codigo = get_codigo_programa(account_name, programa)
+
+    if codigo is not None:
+        col_cap, col_cus = COLS_RECURSO['Capital'], COLS_RECURSO['Custeio']
+        if njit is not None:
+            cap, cus = _saldo_scan(
+                df['programa_cod'].to_numpy(), df['ano'].to_numpy(), df['mes_num'].to_numpy(),
+                *[df[c].to_numpy() for c in col_cap + col_cus],
+                codigo, ano_alvo, mes_alvo)
+        else:
+            mask = (df['programa_cod'] == codigo) & ((df['ano'] < ano_alvo) | (
+                (df['ano'] == ano_alvo) & (df['mes_num'] < mes_alvo)))
+            somas = df.loc[mask, list(col_cap + col_cus)].sum()
+            cap = somas[col_cap[0]] + somas[col_cap[1]] - somas[col_cap[2]]
+            cus = somas[col_cus[0]] + somas[col_cus[1]] - somas[col_cus[2]]
+        saldo_cap += cap
+        saldo_cus += cus
+
+    resultado = (float(saldo_cap), float(saldo_cus))
+    cache[chave] = (versao, resultado)
+    return resultado
 
 
 def sidebar_config():
@@ -313,6 +524,7 @@ def sidebar_config():
 
     if st.sidebar.button("🔄 Recarregar Dados", help="Use se notar dados desatualizados"):
         st.cache_resource.clear()
+        st.cache_data.clear()
         for key in list(st.session_state.keys()):
             del st.session_state[key]
         st.rerun()
@@ -411,52 +623,149 @@ def sidebar_config():
 
 
 def calcular_rateio_rendimento(conta, mes_num, ano, rendimento_total_banco, dados_entrada):
-    saldos_base = {}
-    total_saldo_conta = 0.0
-    for prog, valores in dados_entrada.items():
-        saldo_ant_cap = get_saldo_anterior(
-            conta, prog, 'Capital', mes_num, ano)
-        saldo_ant_cus = get_saldo_anterior(
-            conta, prog, 'Custeio', mes_num, ano)
-        base_cap = max(0, saldo_ant_cap +
-                       valores['cred_cap'] - valores['deb_cap'])
-        base_cus = max(0, saldo_ant_cus +
-                       valores['cred_cus'] - valores['deb_cus'])
-        saldos_base[prog] = {'Capital': base_cap, 'Custeio': base_cus}
-        total_saldo_conta += (base_cap + base_cus)
+    valores = list(dados_entrada.values())
+    entrada = np.array([(v['cred_cap'], v['cred_cus'], v['deb_cap'], v['deb_cus'])
+                        for v in valores], dtype=float).reshape(-1, 4)
+    saldos_ant = np.array([get_saldos_anteriores(conta, prog, mes_num, ano)
+                          for prog in dados_entrada], dtype=float).reshape(-1, 2)
+
+    base_cap = np.clip(saldos_ant[:, 0] + entrada[:, 0] - entrada[:, 2], 0, None)
+    base_cus = np.clip(saldos_ant[:, 1] + entrada[:, 1] - entrada[:, 3], 0, None)
+    total_saldo_conta = base_cap.sum() + base_cus.sum()
+
+    if total_saldo_conta > 0:
+        rend_cap = rendimento_total_banco * (base_cap / total_saldo_conta)
+        rend_cus = rendimento_total_banco * (base_cus / total_saldo_conta)
+    else:
+        rend_cap = np.zeros_like(base_cap)
+        rend_cus = np.zeros_like(base_cus)
 
     resultados = []
-    for prog, valores in dados_entrada.items():
-        base_prog = saldos_base[prog]
-        fator_cap = base_prog['Capital'] / \
-            total_saldo_conta if total_saldo_conta > 0 else 0
-        fator_cus = base_prog['Custeio'] / \
-            total_saldo_conta if total_saldo_conta > 0 else 0
-        rend_cap = rendimento_total_banco * fator_cap
-        rend_cus = rendimento_total_banco * fator_cus
+    for prog, v, r_cap, r_cus in zip(dados_entrada, valores, rend_cap.tolist(), rend_cus.tolist()):
         resultados.append({
             'programa': prog, 'mes_num': mes_num, 'ano': ano,
-            'credito_capital': valores['cred_cap'], 'credito_custeio': valores['cred_cus'],
-            'debito_capital': valores['deb_cap'], 'debito_custeio': valores['deb_cus'],
-            'rendimento_capital': rend_cap, 'rendimento_custeio': rend_cus,
-            'total_credito': valores['cred_cap'] + valores['cred_cus'],
-            'total_debito': valores['deb_cap'] + valores['deb_cus'],
-            'total_rendimento': rend_cap + rend_cus
+            'credito_capital': v['cred_cap'], 'credito_custeio': v['cred_cus'],
+            'debito_capital': v['deb_cap'], 'debito_custeio': v['deb_cus'],
+            'rendimento_capital': r_cap, 'rendimento_custeio': r_cus,
+            'total_credito': v['cred_cap'] + v['cred_cus'],
+            'total_debito': v['deb_cap'] + v['deb_cus'],
+            'total_rendimento': r_cap + r_cus
         })
     return resultados
 
 
+def _build_extrato_df(conta_name, ano, programas):
+    """
+    Extrato Mensal (movimentos e saldos acumulados por programa).
+    Cache por sessão, invalidado pela versão da conta.
+    """
+    versao = get_account_version(conta_name)
+    cache = st.session_state.setdefault('extrato_cache', {})
+    chave = (conta_name, int(ano), tuple(programas))
+    if chave in cache and cache[chave][0] == versao:
+        return cache[chave][1]
+
+    df_movs = get_movimentacoes_df(conta_name)
+    df_ano = df_movs[df_movs['ano'] == ano]
+    df_ext = df_ano[df_ano['programa'].isin(programas)].sort_values(
+        ['programa', 'mes_num'], kind='stable')
+    grupos = df_ext.assign(
+        mov_cap=df_ext['credito_capital'] +
+        df_ext['rendimento_capital'] - df_ext['debito_capital'],
+        mov_cus=df_ext['credito_custeio'] +
+        df_ext['rendimento_custeio'] - df_ext['debito_custeio']
+    ).groupby('programa', sort=False, observed=True)
+
+    pieces = []
+    for p in programas:
+        if p in grupos.groups:
+            m = grupos.get_group(p)
+            saldo_ini_cap, saldo_ini_cus = get_saldos_anteriores(
+                conta_name, p, 1, ano)
+            saldo_acumulado_cap = saldo_ini_cap + m['mov_cap'].cumsum()
+            saldo_acumulado_cus = saldo_ini_cus + m['mov_cus'].cumsum()
+            df_prog = pd.DataFrame({
+                "Programa": p, "Mês": m['mes_num'].map(MESES),
+                "Créd. Cap.": m['credito_capital'], "Créd. Cust.": m['credito_custeio'], "Créd. Total": m['total_credito'],
+                "Rend. Cap.": m['rendimento_capital'], "Rend. Cust.": m['rendimento_custeio'], "Rend. Total": m['total_rendimento'],
+                "Déb. Cap.": m['debito_capital'], "Déb. Cust.": m['debito_custeio'], "Déb. Total": m['total_debito'],
+                "S. Custeio": saldo_acumulado_cus, "S. Capital": saldo_acumulado_cap,
+                "S. Total": saldo_acumulado_cap + saldo_acumulado_cus
+            }).reset_index(drop=True)
+            linha_total = pd.DataFrame([{
+                "Programa": "TOTAL", "Mês": "---",
+                "Créd. Cap.": df_prog["Créd. Cap."].sum(), "Créd. Cust.": df_prog["Créd. Cust."].sum(), "Créd. Total": df_prog["Créd. Total"].sum(),
+                "Rend. Cap.": df_prog["Rend. Cap."].sum(), "Rend. Cust.": df_prog["Rend. Cust."].sum(), "Rend. Total": df_prog["Rend. Total"].sum(),
+                "Déb. Cap.": df_prog["Déb. Cap."].sum(), "Déb. Cust.": df_prog["Déb. Cust."].sum(), "Déb. Total": df_prog["Déb. Total"].sum(),
+                "S. Custeio": df_prog["S. Custeio"].iloc[-1], "S. Capital": df_prog["S. Capital"].iloc[-1], "S. Total": df_prog["S. Total"].iloc[-1]
+            }])
+            pieces.extend([df_prog, linha_total])
+
+    df_final = pd.concat(
+        pieces, ignore_index=True) if pieces else pd.DataFrame()
+    cache[chave] = (versao, df_final)
+    return df_final
+
+
+def _build_resumo_df(conta_name, ano, programas):
+    """
+    Resumo Geral de todos os programas no ano, com a linha TOTAL GERAL.
+    Cache por sessão, invalidado pela versão da conta.
+    """
+    versao = get_account_version(conta_name)
+    cache = st.session_state.setdefault('resumo_cache', {})
+    chave = (conta_name, int(ano), tuple(programas))
+    if chave in cache and cache[chave][0] == versao:
+        return cache[chave][1]
+
+    conta_data = st.session_state['accounts'][conta_name]
+    df_movs = get_movimentacoes_df(conta_name)
+    df_ano = df_movs[df_movs['ano'] == ano]
+    programas = list(programas)
+    agg = df_ano.groupby('programa', observed=True)[COLS_TOTAIS].sum()
+    agg = agg.set_axis(agg.index.astype(object)).reindex(
+        programas, fill_value=0.0)
+    ajustes = pd.DataFrame(
+        [conta_data.get('extra_fields', {}).get(p, {}) for p in programas], index=programas,
+        columns=['rec_prop_cust', 'rec_prop_cap', 'devol_cust', 'devol_cap']).fillna(0.0)
+
+    df_resumo = agg.assign(
+        saldo_anterior=agg.index.map(
+            lambda p: sum(get_saldos_anteriores(conta_name, p, 1, ano))),
+        credito=agg['total_credito'] +
+        ajustes['rec_prop_cust'] + ajustes['rec_prop_cap'],
+        debito=agg['total_debito'] +
+        ajustes['devol_cust'] + ajustes['devol_cap'],
+    ).assign(
+        saldo_final=lambda d: d['saldo_anterior'] +
+        d['credito'] + d['total_rendimento'] - d['debito']
+    )[['saldo_anterior', 'credito', 'total_rendimento', 'debito', 'saldo_final']]
+    df_resumo = pd.concat(
+        [df_resumo, df_resumo.sum(numeric_only=True).to_frame('TOTAL GERAL').T])
+
+    df_resumo = df_resumo.rename(columns={
+        'saldo_anterior': f"Saldo {ano-1}",
+        'credito': f"Crédito {ano}",
+        'total_rendimento': f"Rendimentos {ano}",
+        'debito': f"Débitos {ano}",
+        'saldo_final': f"Saldo 31.12.{ano}"
+    }).rename_axis("Programas").reset_index()
+    cache[chave] = (versao, df_resumo)
+    return df_resumo
+
+
 def render_financeiro_view(conta_atual, ano_atual, programas):
+    df_movs = get_movimentacoes_df(conta_atual)
+    df_ano = df_movs[df_movs['ano'] == ano_atual]
+
     tab_lanc, tab_rel, tab_resumo = st.tabs(
         ["📝 Lançamentos", "📑 Extrato Mensal", "📊 Resumo Geral"])
 
     with tab_lanc:
-        col_mes, col_rend = st.columns([1, 2])
-        meses = {1: 'Janeiro', 2: 'Fevereiro', 3: 'Março', 4: 'Abril', 5: 'Maio', 6: 'Junho',
-                 7: 'Julho', 8: 'Agosto', 9: 'Setembro', 10: 'Outubro', 11: 'Novembro', 12: 'Dezembro'}
+        col_mes, _ = st.columns([1, 2])
         with col_mes:
-            mes_selecionado = st.selectbox("Mês", options=list(meses.keys(
-            )), format_func=lambda x: meses[x], key=f"sel_mes_{conta_atual}_{ano_atual}")
+            mes_selecionado = st.selectbox("Mês", options=list(MESES.keys(
+            )), format_func=lambda x: MESES[x], key=f"sel_mes_{conta_atual}_{ano_atual}")
 
         movs = st.session_state['accounts'][conta_atual].get(
             'movimentacoes', [])
@@ -465,126 +774,89 @@ def render_financeiro_view(conta_atual, ano_atual, programas):
         val_rendimento_inicial = sum(
             [m['total_rendimento'] for m in registros_existentes]) if registros_existentes else 0.0
         if registros_existentes:
-            st.info(f"✏️ Editando dados de {meses[mes_selecionado]}.")
+            st.info(f"✏️ Editando dados de {MESES[mes_selecionado]}.")
 
-        with col_rend:
+        # Os valores só são enviados ao salvar, evitando um rerun a cada campo editado
+        with st.form(f"form_lanc_{conta_atual}_{ano_atual}_{mes_selecionado}"):
             rendimento_total = st.number_input(
                 "💰 Rendimento/Ajuste (Total Extrato)",
                 value=float(val_rendimento_inicial), step=0.01, format="%.2f",
                 key=f"rend_tot_{conta_atual}_{ano_atual}_{mes_selecionado}"
             )
 
-        st.divider()
-        dados_entrada = {}
-        has_error = False
-        for prog in programas:
-            prog_data = next(
-                (m for m in registros_existentes if m['programa'] == prog), None)
-            v_cc = float(prog_data['credito_capital']) if prog_data else 0.0
-            v_crc = float(prog_data['credito_custeio']) if prog_data else 0.0
-            v_dc = float(prog_data['debito_capital']) if prog_data else 0.0
-            v_dec = float(prog_data['debito_custeio']) if prog_data else 0.0
-
-            saldo_disp_cap = get_saldo_anterior(
-                conta_atual, prog, 'Capital', mes_selecionado, ano_atual)
-            saldo_disp_cust = get_saldo_anterior(
-                conta_atual, prog, 'Custeio', mes_selecionado, ano_atual)
-
-            with st.expander(f"Movimento: {prog}", expanded=True):
-                c1, c2, c3, c4 = st.columns(4)
-                st.markdown(
-                    f"**Saldo Ant.:** Cap: {format_currency(saldo_disp_cap)} | Cust: {format_currency(saldo_disp_cust)}")
-                k_suf = f"{conta_atual}_{prog}_{ano_atual}_{mes_selecionado}"
-                cred_cap = c1.number_input(
-                    f"Créd. Capital", min_value=0.0, value=v_cc, key=f"cc_{k_suf}")
-                cred_cus = c2.number_input(
-                    f"Créd. Custeio", min_value=0.0, value=v_crc, key=f"crc_{k_suf}")
-                deb_cap = c3.number_input(
-                    f"Déb. Capital", min_value=0.0, value=v_dc, key=f"dc_{k_suf}")
-                deb_cus = c4.number_input(
-                    f"Déb. Custeio", min_value=0.0, value=v_dec, key=f"dec_{k_suf}")
-
-                saldo_proj_cap = saldo_disp_cap + cred_cap - deb_cap
-                saldo_proj_cust = saldo_disp_cust + cred_cus - deb_cus
-                if saldo_proj_cap < 0:
-                    st.error(
-                        f"⚠️ Atenção: Saldo de Capital ficará negativo ({format_currency(saldo_proj_cap)})!")
-                    has_error = True
-                if saldo_proj_cust < 0:
+            st.divider()
+            dados_entrada = {}
+            has_error = False
+            registros_por_programa = {m['programa']: m for m in registros_existentes}
+            for prog in programas:
+                prog_data = registros_por_programa.get(prog)
+                v_cc = float(prog_data['credito_capital']) if prog_data else 0.0
+                v_crc = float(prog_data['credito_custeio']) if prog_data else 0.0
+                v_dc = float(prog_data['debito_capital']) if prog_data else 0.0
+                v_dec = float(prog_data['debito_custeio']) if prog_data else 0.0
+
+                saldo_disp_cap, saldo_disp_cust = get_saldos_anteriores(
+                    conta_atual, prog, mes_selecionado, ano_atual)
+
+                with st.expander(f"Movimento: {prog}", expanded=True):
+                    c1, c2, c3, c4 = st.columns(4)
+                    st.markdown(
+                        f"**Saldo Ant.:** Cap: {format_currency(saldo_disp_cap)} | Cust: {format_currency(saldo_disp_cust)}")
+                    k_suf = f"{conta_atual}_{prog}_{ano_atual}_{mes_selecionado}"
+                    cred_cap = c1.number_input(
+                        f"Créd. Capital", min_value=0.0, value=v_cc, key=f"cc_{k_suf}")
+                    cred_cus = c2.number_input(
+                        f"Créd. Custeio", min_value=0.0, value=v_crc, key=f"crc_{k_suf}")
+                    deb_cap = c3.number_input(
+                        f"Déb. Capital", min_value=0.0, value=v_dc, key=f"dc_{k_suf}")
+                    deb_cus = c4.number_input(
+                        f"Déb. Custeio", min_value=0.0, value=v_dec, key=f"dec_{k_suf}")
+
+                    saldo_proj_cap = saldo_disp_cap + cred_cap - deb_cap
+                    saldo_proj_cust = saldo_disp_cust + cred_cus - deb_cus
+                    if saldo_proj_cap < 0:
+                        st.error(
+                            f"⚠️ Atenção: Saldo de Capital ficará negativo ({format_currency(saldo_proj_cap)})!")
+                        has_error = True
+                    if saldo_proj_cust < 0:
+                        st.error(
+                            f"⚠️ Atenção: Saldo de Custeio ficará negativo ({format_currency(saldo_proj_cust)})!")
+                        has_error = True
+                    dados_entrada[prog] = {
+                        'cred_cap': cred_cap, 'cred_cus': cred_cus, 'deb_cap': deb_cap, 'deb_cus': deb_cus}
+
+            salvar = st.form_submit_button(
+                f"💾 Salvar Lançamento {MESES[mes_selecionado]}/{ano_atual}", type="primary")
+            if salvar:
+                if has_error:
                     st.error(
-                        f"⚠️ Atenção: Saldo de Custeio ficará negativo ({format_currency(saldo_proj_cust)})!")
-                    has_error = True
-                dados_entrada[prog] = {
-                    'cred_cap': cred_cap, 'cred_cus': cred_cus, 'deb_cap': deb_cap, 'deb_cus': deb_cus}
-
-        if st.button(f"💾 Salvar Lançamento {meses[mes_selecionado]}/{ano_atual}", type="primary", key=f"btn_save_{conta_atual}_{ano_atual}_{mes_selecionado}"):
-            if has_error:
-                st.error(
-                    "❌ Não é possível salvar pois há saldos negativos. Verifique os valores.")
-            else:
-                novos = calcular_rateio_rendimento(
-                    conta_atual, mes_selecionado, ano_atual, rendimento_total, dados_entrada)
-                lista_atual = st.session_state['accounts'][conta_atual].get(
-                    'movimentacoes', [])
-                lista_limpa = [m for m in lista_atual if not (
-                    m['mes_num'] == mes_selecionado and m.get('ano', datetime.now().year) == ano_atual)]
-                lista_limpa.extend(novos)
-                st.session_state['accounts'][conta_atual]['movimentacoes'] = lista_limpa
-                save_account_to_firebase(
-                    st.session_state['db_conn'], conta_atual, st.session_state['accounts'][conta_atual])
-                st.success("Dados salvos com sucesso!")
-                st.rerun()
+                        "❌ Não é possível salvar pois há saldos negativos. Verifique os valores.")
+                else:
+                    novos = calcular_rateio_rendimento(
+                        conta_atual, mes_selecionado, ano_atual, rendimento_total, dados_entrada)
+                    lista_atual = st.session_state['accounts'][conta_atual].get(
+                        'movimentacoes', [])
+                    lista_limpa = [m for m in lista_atual if not (
+                        m['mes_num'] == mes_selecionado and m.get('ano', datetime.now().year) == ano_atual)]
+                    lista_limpa.extend(novos)
+                    st.session_state['accounts'][conta_atual]['movimentacoes'] = lista_limpa
+                    save_account_to_firebase(
+                        st.session_state['db_conn'], conta_atual, st.session_state['accounts'][conta_atual],
+                        meses=[(int(ano_atual), int(mes_selecionado))])
+                    st.success("Dados salvos com sucesso!")
+                    st.rerun()
 
     with tab_rel:
         st.subheader(f"Extrato Mensal Detalhado - {ano_atual}")
         filtro_prog = st.selectbox("Filtrar Programa", [
                                    "Todos"] + programas, key=f"filt_prog_{conta_atual}_{ano_atual}")
-        movs = st.session_state['accounts'][conta_atual].get(
-            'movimentacoes', [])
         programas_para_listar = programas if filtro_prog == "Todos" else [
             filtro_prog]
 
-        df_final = pd.DataFrame()
-        for p in programas_para_listar:
-            dados_tabela = []
-            saldo_acumulado_cap = get_saldo_anterior(
-                conta_atual, p, 'Capital', 1, ano_atual)
-            saldo_acumulado_cus = get_saldo_anterior(
-                conta_atual, p, 'Custeio', 1, ano_atual)
-            movs_prog_ano = [m for m in movs if m['programa'] ==
-                             p and m.get('ano', datetime.now().year) == ano_atual]
-            movs_prog_ano.sort(key=lambda x: x['mes_num'])
-
-            for m in movs_prog_ano:
-                saldo_acumulado_cap += (m['credito_capital'] +
-                                        m['rendimento_capital'] - m['debito_capital'])
-                saldo_acumulado_cus += (m['credito_custeio'] +
-                                        m['rendimento_custeio'] - m['debito_custeio'])
-                saldo_total = saldo_acumulado_cap + saldo_acumulado_cus
-                dados_tabela.append({
-                    "Programa": p, "Mês": meses[m['mes_num']],
-                    "Créd. Cap.": m['credito_capital'], "Créd. Cust.": m['credito_custeio'], "Créd. Total": m['total_credito'],
-                    "Rend. Cap.": m['rendimento_capital'], "Rend. Cust.": m['rendimento_custeio'], "Rend. Total": m['total_rendimento'],
-                    "Déb. Cap.": m['debito_capital'], "Déb. Cust.": m['debito_custeio'], "Déb. Total": m['total_debito'],
-                    "S. Custeio": saldo_acumulado_cus, "S. Capital": saldo_acumulado_cap, "S. Total": saldo_total
-                })
-
-            if dados_tabela:
-                df_prog = pd.DataFrame(dados_tabela)
-                linha_total = pd.DataFrame([{
-                    "Programa": "TOTAL", "Mês": "---",
-                    "Créd. Cap.": df_prog["Créd. Cap."].sum(), "Créd. Cust.": df_prog["Créd. Cust."].sum(), "Créd. Total": df_prog["Créd. Total"].sum(),
-                    "Rend. Cap.": df_prog["Rend. Cap."].sum(), "Rend. Cust.": df_prog["Rend. Cust."].sum(), "Rend. Total": df_prog["Rend. Total"].sum(),
-                    "Déb. Cap.": df_prog["Déb. Cap."].sum(), "Déb. Cust.": df_prog["Déb. Cust."].sum(), "Déb. Total": df_prog["Déb. Total"].sum(),
-                    "S. Custeio": df_prog["S. Custeio"].iloc[-1], "S. Capital": df_prog["S. Capital"].iloc[-1], "S. Total": df_prog["S. Total"].iloc[-1]
-                }])
-                df_final = pd.concat(
-                    [df_final, df_prog, linha_total], ignore_index=True)
+        df_final = _build_extrato_df(
+            conta_atual, ano_atual, programas_para_listar)
 
         if not df_final.empty:
-            def highlight_total(row):
-                return ['background-color: #ffd700; color: black; font-weight: bold'] * len(row) if row['Programa'] == 'TOTAL' else [''] * len(row)
-
             cols_to_format = [
                 "Créd. Cap.", "Créd. Cust.", "Créd. Total",
                 "Rend. Cap.", "Rend. Cust.", "Rend. Total",
@@ -592,8 +864,9 @@ def render_financeiro_view(conta_atual, ano_atual, programas):
                 "S. Custeio", "S. Capital", "S. Total"
             ]
             df_display = apply_currency_format(df_final.copy(), cols_to_format)
-            st.dataframe(df_display.style.apply(highlight_total,
-                         axis=1), use_container_width=True, height=500)
+            total_mask = df_display['Programa'] == 'TOTAL'
+            st.dataframe(df_display.style.set_properties(
+                subset=pd.IndexSlice[total_mask, :], **ESTILO_TOTAL), use_container_width=True, height=500)
         else:
             st.info(f"Nenhuma movimentação em {ano_atual}.")
 
@@ -639,22 +912,17 @@ def render_financeiro_view(conta_atual, ano_atual, programas):
                     st.success("Ajustes salvos!")
                     st.rerun()
 
-            s_reprog_cust = get_saldo_anterior(
-                conta_atual, prog_demo, 'Custeio', 1, ano_atual)
-            s_reprog_cap = get_saldo_anterior(
-                conta_atual, prog_demo, 'Capital', 1, ano_atual)
+            s_reprog_cap, s_reprog_cust = get_saldos_anteriores(
+                conta_atual, prog_demo, 1, ano_atual)
 
-            movs = st.session_state['accounts'][conta_atual].get(
-                'movimentacoes', [])
-            movs_demo = [m for m in movs if m['programa']
-                         == prog_demo and m.get('ano') == ano_atual]
+            movs_demo = df_ano[df_ano['programa'] == prog_demo]
 
-            cred_cust = sum(m['credito_custeio'] for m in movs_demo)
-            cred_cap = sum(m['credito_capital'] for m in movs_demo)
-            rend_cust = sum(m['rendimento_custeio'] for m in movs_demo)
-            rend_cap = sum(m['rendimento_capital'] for m in movs_demo)
-            desp_cust = sum(m['debito_custeio'] for m in movs_demo)
-            desp_cap = sum(m['debito_capital'] for m in movs_demo)
+            cred_cust = movs_demo['credito_custeio'].sum()
+            cred_cap = movs_demo['credito_capital'].sum()
+            rend_cust = movs_demo['rendimento_custeio'].sum()
+            rend_cap = movs_demo['rendimento_capital'].sum()
+            desp_cust = movs_demo['debito_custeio'].sum()
+            desp_cap = movs_demo['debito_capital'].sum()
 
             rec_prop_cust = extras.get('rec_prop_cust', 0.0)
             rec_prop_cap = extras.get('rec_prop_cap', 0.0)
@@ -696,67 +964,30 @@ def render_financeiro_view(conta_atual, ano_atual, programas):
             ])
             df_demo["Total"] = df_demo["Custeio"] + df_demo["Capital"]
 
-            def highlight_demo_rows(row):
-                if "13 - VALOR" in row['Descrição'] or "15 - Saldo" in row['Descrição']:
-                    return ['background-color: #e0f2f1; color: black; font-weight: bold'] * len(row)
-                return [''] * len(row)
-
             df_demo_display = apply_currency_format(
                 df_demo.copy(), ["Custeio", "Capital", "Total"])
-            st.dataframe(df_demo_display.style.apply(
-                highlight_demo_rows, axis=1), use_container_width=True, height=350)
+            destaque_mask = df_demo_display['Descrição'].str.contains(
+                "13 - VALOR|15 - Saldo")
+            st.dataframe(df_demo_display.style.set_properties(
+                subset=pd.IndexSlice[destaque_mask, :], **ESTILO_DESTAQUE), use_container_width=True, height=350)
 
         with st.expander("Ver Resumo Geral de Todos os Programas"):
-            dados_resumo = []
             conta_dados = st.session_state['accounts'][conta_atual]
             if 'extra_fields' not in conta_dados:
                 conta_dados['extra_fields'] = {}
 
-            for prog in programas:
-                saldo_anterior = get_saldo_anterior(
-                    conta_atual, prog, 'Total', 1, ano_atual)
-                movs_ano = [m for m in movs if m['programa']
-                            == prog and m.get('ano') == ano_atual]
-
-                credito_ano = sum(m['total_credito'] for m in movs_ano)
-                rendimento_ano = sum(m['total_rendimento'] for m in movs_ano)
-                debito_ano = sum(m['total_debito'] for m in movs_ano)
-
-                extras_p = conta_dados['extra_fields'].get(prog, {})
-                ajuste_entradas = extras_p.get(
-                    'rec_prop_cust', 0) + extras_p.get('rec_prop_cap', 0)
-                ajuste_saidas = extras_p.get(
-                    'devol_cust', 0) + extras_p.get('devol_cap', 0)
-
-                saldo_final = saldo_anterior + credito_ano + rendimento_ano + \
-                    ajuste_entradas - debito_ano - ajuste_saidas
-
-                dados_resumo.append({
-                    "Programas": prog,
-                    f"Saldo {ano_atual-1}": saldo_anterior,
-                    f"Crédito {ano_atual}": credito_ano + ajuste_entradas,
-                    f"Rendimentos {ano_atual}": rendimento_ano,
-                    f"Débitos {ano_atual}": debito_ano + ajuste_saidas,
-                    f"Saldo 31.12.{ano_atual}": saldo_final
-                })
-
-            if dados_resumo:
-                df_resumo = pd.DataFrame(dados_resumo)
+            if programas:
+                df_resumo = _build_resumo_df(
+                    conta_atual, ano_atual, programas)
                 cols_num = [c for c in df_resumo.columns if c != "Programas"]
-                linha_total = {"Programas": "TOTAL GERAL"}
-                for c in cols_num:
-                    linha_total[c] = df_resumo[c].sum()
-
-                df_resumo = pd.concat(
-                    [df_resumo, pd.DataFrame([linha_total])], ignore_index=True)
-
-                def highlight_total_resumo(row):
-                    return ['background-color: #ffd700; color: black; font-weight: bold'] * len(row) if row['Programas'] == 'TOTAL GERAL' else [''] * len(row)
 
                 df_resumo_display = apply_currency_format(
                     df_resumo.copy(), cols_num)
-                st.dataframe(df_resumo_display.style.apply(
-                    highlight_total_resumo, axis=1), use_container_width=True)
+                # A linha TOTAL GERAL é sempre a última (anexada no build).
+                total_mask = df_resumo_display.index == len(
+                    df_resumo_display) - 1
+                st.dataframe(df_resumo_display.style.set_properties(
+                    subset=pd.IndexSlice[total_mask, :], **ESTILO_TOTAL), use_container_width=True)
 
 # === VISUALIZAÇÃO 3: RESUMO CONSOLIDADO ===
 
@@ -776,23 +1007,23 @@ def render_resumo_consolidado_view():
     lista_detalhada = []
 
     for nome_conta, dados_conta in st.session_state['accounts'].items():
-        movs = dados_conta.get('movimentacoes', [])
+        df_movs = get_movimentacoes_df(nome_conta)
         progs = dados_conta.get('programas', [])
-        movs_ano = [m for m in movs if m.get('ano') == ano_int]
+        movs_ano = df_movs[df_movs['ano'] == ano_int]
         if 'extra_fields' not in dados_conta:
             dados_conta['extra_fields'] = {}
 
         saldo_inicial_conta = 0.0
-        creditos_conta = sum(m['total_credito'] for m in movs_ano)
-        rendimentos_conta = sum(m['total_rendimento'] for m in movs_ano)
-        debitos_conta = sum(m['total_debito'] for m in movs_ano)
+        creditos_conta = float(movs_ano['total_credito'].sum())
+        rendimentos_conta = float(movs_ano['total_rendimento'].sum())
+        debitos_conta = float(movs_ano['total_debito'].sum())
 
         ajuste_entradas_conta = 0.0
         ajuste_saidas_conta = 0.0
 
         for p in progs:
-            saldo_inicial_conta += get_saldo_anterior(
-                nome_conta, p, 'Total', 1, ano_int)
+            saldo_inicial_conta += sum(get_saldos_anteriores(
+                nome_conta, p, 1, ano_int))
             extras_p = dados_conta['extra_fields'].get(p, {})
             ajuste_entradas_conta += (extras_p.get('rec_prop_cust',
                                       0) + extras_p.get('rec_prop_cap', 0))
@@ -839,16 +1070,14 @@ def render_resumo_consolidado_view():
         df_resumo = pd.concat(
             [df_resumo, pd.DataFrame([linha_total])], ignore_index=True)
 
-        def highlight_total(row):
-            return ['background-color: #ffd700; color: black; font-weight: bold'] * len(row) if row['Conta'] == 'TOTAL GERAL' else [''] * len(row)
-
         cols_to_fmt = [
             "Saldo Anterior", "Créditos (+RP)", "Rendimentos", "Débitos (+Dev)", "Saldo Final"]
         df_resumo_display = apply_currency_format(
             df_resumo.copy(), cols_to_fmt)
 
-        st.dataframe(df_resumo_display.style.apply(
-            highlight_total, axis=1), use_container_width=True, height=400)
+        total_mask = df_resumo_display['Conta'] == 'TOTAL GERAL'
+        st.dataframe(df_resumo_display.style.set_properties(
+            subset=pd.IndexSlice[total_mask, :], **ESTILO_TOTAL), use_container_width=True, height=400)
     else:
         st.info("Nenhuma conta encontrada.")
 
@@ -1202,10 +1431,13 @@ def main():
         if st.session_state['accounts'][nome]['programas']:
             anos = sorted(st.session_state.get(
                 'available_years', [datetime.now().year]))
-            for aba_ano, ano in zip(st.tabs([str(a) for a in anos]), anos):
-                with aba_ano:
-                    render_financeiro_view(
-                        nome, ano, st.session_state['accounts'][nome]['programas'])
+            # Só o exercício selecionado é renderizado (st.tabs executaria todos)
+            ano_atual = datetime.now().year
+            ano = st.radio("Exercício", anos, horizontal=True,
+                           index=anos.index(ano_atual) if ano_atual in anos else len(anos)-1,
+                           key=f"sel_ano_{nome}")
+            render_financeiro_view(
+                nome, ano, st.session_state['accounts'][nome]['programas'])
         else:
             st.warning("Cadastre programas acima para começar.")
 